@@ -1,17 +1,31 @@
 import ast
+import collections
+import dbm
 import fnmatch
-import imp
+import functools
+import importlib
 import logging
+import marshal
 import os
-import pkg_resources
 import re
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib.machinery import PathFinder
 
-from packaging.utils import canonicalize_name
-from pip._internal.network.session import PipSession
-from pip._internal.req.req_file import parse_requirements
+from packaging.utils import canonicalize_name as _canonicalize_name
+# (pip and pkg_resources take a good part of a second to import, so they're
+# imported where they're used: --help, --version and usage errors don't
+# need them)
+
+from pip_check_reqs import __version__
 
 log = logging.getLogger(__name__)
 
+# the same distribution names get normalised over and over while matching
+# installed files and requirements, so remember the answers
+canonicalize_name = functools.lru_cache(maxsize=None)(_canonicalize_name)
+
 
 class FoundModule:
     def __init__(self, modname, filename, locations=None):
@@ -23,179 +37,739 @@ class FoundModule:
         return 'FoundModule("%s")' % self.modname
 
 
+# the only nodes which can contain statements (and so imports)
+_STATEMENT_HOLDERS = tuple(getattr(ast, name)
+    for name in ('stmt', 'excepthandler', 'match_case') if hasattr(ast, name))
+
+
 class ImportVisitor(ast.NodeVisitor):
     def __init__(self, options):
         super(ImportVisitor, self).__init__()
         self.__options = options
         self.__modules = {}
+        self.__ignored = {}
         self.__location = None
 
     def set_location(self, location):
         self.__location = location
 
+    def visit(self, node):
+        # only imports are of interest so rather than dispatching through a
+        # getattr() for every node in the tree, pick them out in one walk -
+        # which needn't go into expressions as they never hold statements
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node_type = type(node)
+            if node_type is ast.Import:
+                self.visit_Import(node)
+            elif node_type is ast.ImportFrom:
+                self.visit_ImportFrom(node)
+            else:
+                stack.extend(reversed([child
+                    for child in ast.iter_child_nodes(node)
+                    if isinstance(child, _STATEMENT_HOLDERS)]))
+
     def visit_Import(self, node):
         for alias in node.names:
-            self.__addModule(alias.name, node.lineno)
+            self.add_module(alias.name, node.lineno)
 
     def visit_ImportFrom(self, node):
+        if node.module is None:
+            # relative import
+            return
         if node.module == '__future__':
             # not an actual module
             return
+        prefix = node.module + '.'
         for alias in node.names:
-            if node.module is None:
-                # relative import
-                continue
-            self.__addModule(node.module + '.' + alias.name, node.lineno)
-
-    def __addModule(self, modname, lineno):
-        if self.__options.ignore_mods(modname):
+            self.add_module(prefix + alias.name, node.lineno)
+
+    def add_module(self, modname, lineno):
+        # the same names are imported in file after file, so only ask
+        # whether each one is ignored the first time it comes up
+        ignored = self.__ignored.get(modname)
+        if ignored is None:
+            ignored = self.__ignored[modname] = \
+                self.__options.ignore_mods(modname)
+        if ignored:
             return
-        path = None
-        progress = []
-        modpath = last_modpath = None
-        for p in modname.split('.'):
-            try:
-                file, modpath, description = imp.find_module(p, path)
-            except ImportError:
-                # the component specified at this point is not importable
-                # (is just an attr of the module)
-                # *or* it's not actually installed, so we don't care either
-                break
-
-            # success! we found *something*
-            progress.append(p)
-
-            # we might have previously seen a useful path though...
-            if modpath is None:   # pragma: no cover
-                # the sys module will hit this code path on py3k - possibly
-                # others will, but I've not discovered them
-                modpath = last_modpath
-                break
-
-            # ... though it might not be a file, so not interesting to us
-            if not os.path.isdir(modpath):
-                break
-
-            path = [modpath]
-            last_modpath = modpath
-
-        if modpath is None:
+        resolved = _resolve_module(modname)
+        if resolved is None:
             # the module doesn't actually appear to exist on disk
             return
 
-        modname = '.'.join(progress)
+        modname, modpath = resolved
         if modname not in self.__modules:
             self.__modules[modname] = FoundModule(modname, modpath)
-        self.__modules[modname].locations.append((self.__location, lineno))
+        locations = self.__modules[modname].locations
+        location = (self.__location, lineno)
+        # "from spam import ham, eggs" resolves to spam twice; files are
+        # visited one at a time, in order, so any repeat is the last entry
+        if not locations or locations[-1] != location:
+            locations.append(location)
 
     def finalise(self):
         return self.__modules
 
 
-def pyfiles(root):
+class _ImportCollector(ImportVisitor):
+    '''Collects the (modname, lineno) of each import without resolving it,
+    so the results are cheap to send back from a worker process.
+    '''
+    def __init__(self):
+        super(_ImportCollector, self).__init__(None)
+        self.imports = []
+
+    def add_module(self, modname, lineno):
+        self.imports.append((modname, lineno))
+
+
+@functools.lru_cache(maxsize=None)
+def _locate(name):
+    '''Find the dotted module name on disk, given that its parents are all
+    packages. Returns a (search_locations, modpath) tuple - where
+    search_locations is None for a plain module - or None if there's no
+    such module. Cached per name, so once "spam" turns out not to exist
+    nothing under it is looked for again.
+    '''
+    parent, _, last = name.rpartition('.')
+    path = None
+    if parent:
+        located = _locate(parent)
+        if located is None or located[0] is None:
+            # a plain module can't contain any more modules
+            return None
+        path = list(located[0])
+
+    # anything we've imported ourselves (much of the standard library, for
+    # a start) has already been found, so there's no need to search again
+    spec = getattr(sys.modules.get(name), '__spec__', None)
+    if spec is None or not spec.has_location:
+        # only ever look for one component at a time: asking importlib for
+        # the whole dotted name would import (and so run) the parents
+        spec = PathFinder.find_spec(last, path)
+    if spec is None:
+        return None
+    if not spec.submodule_search_locations:
+        return None, spec.origin
+    locations = tuple(spec.submodule_search_locations)
+    return locations, locations[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_module(modname):
+    '''Find the longest importable prefix of the dotted modname.
+
+    Returns a (modname, modpath) tuple, or None if the module doesn't appear
+    to exist on disk. The same names are imported all over a code base, so
+    lookups (including the failed ones) are cached for the whole run.
+    '''
+    resolved = None
+    found = ''
+    for p in modname.split('.'):
+        name = found + '.' + p if found else p
+        located = _locate(name)
+        if located is None:
+            # the component specified at this point is not importable
+            # (is just an attr of the module)
+            # *or* it's not actually installed, so we don't care either
+            break
+
+        # success! we found *something*
+        found = name
+        resolved = found, located[1]
+
+        if located[0] is None:
+            # ... though a plain module can't contain any more modules
+            break
+
+    return resolved
+
+
+# directories which never hold a project's own source, but can be huge
+_SKIPPED_DIRS = frozenset([
+    '__pycache__', 'node_modules', 'site-packages', 'venv'])
+
+
+def skipped_dir(path):
+    '''Determines whether a directory should be left out of the scan: hidden
+    directories (.git, .tox, .venv, ...), *.egg-info metadata and the
+    well-known names above.
+    '''
+    name = os.path.basename(path)
+    if name.startswith('.') or name in _SKIPPED_DIRS:
+        return True
+    return name.endswith('.egg-info')
+
+
+def pyfiles(root, skip_dir=None):
+    for path, is_link in _pyfiles(root, skip_dir):
+        yield path
+
+
+def _pyfiles(root, skip_dir):
+    '''Yields (path, is_link) for each Python file under the root, where
+    is_link says whether the file is a symlink.
+    '''
     d = os.path.abspath(root)
     if not os.path.isdir(d):
-        n, ext = os.path.splitext(d)
-        if ext == '.py':
-            yield d
-        else:
-            raise ValueError('%s is not a python file or directory' % root)
-    for root, dirs, files in os.walk(d):
-        for f in files:
-            n, ext = os.path.splitext(f)
-            if ext == '.py':
-                yield os.path.join(root, f)
+        if d.endswith('.py'):
+            yield d, False
+            return
+        raise ValueError('%s is not a python file or directory' % root)
+    # walk with scandir rather than os.walk: the directory entries already
+    # know whether they're directories so there's no stat() per entry
+    stack = [d]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            # as os.walk does, leave out directories which can't be listed
+            # (unreadable, or gone since they were found)
+            log.debug('not scanning %s: %s', directory, e)
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if skip_dir is None or not skip_dir(entry.path):
+                        stack.append(entry.path)
+                elif entry.name.endswith('.py') and entry.is_file():
+                    # (is_file() follows symlinks, but answers from the
+                    # directory entry for everything else - as does
+                    # is_symlink())
+                    yield entry.path, entry.is_symlink()
+
+
+def _read_file(filename):
+    # ast.parse() decodes the source itself (honouring any coding
+    # declaration) so there's no need to decode it here first
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def _parse_imports(content, filename):
+    # every import statement has "import" in it somewhere, and looking for
+    # that is far cheaper than parsing files which have none
+    if b'import' not in content:
+        return []
+    collector = _ImportCollector()
+    collector.visit(ast.parse(content, filename))
+    return collector.imports
+
+
+def _scan_file(filename):
+    return _parse_imports(_read_file(filename), filename)
+
+
+def _scan_files(filenames, jobs):
+    # parsing is CPU bound so it may be spread over several processes, but
+    # the modules are always resolved in this one so the lookup cache is
+    # shared
+    if jobs > 1:
+        with ProcessPoolExecutor(jobs) as executor:
+            return list(executor.map(_scan_file, filenames, chunksize=32))
+
+    # otherwise read each file in a thread (which lets go of the GIL while
+    # it waits on the disk) while the one before it is being parsed
+    results = []
+    with ThreadPoolExecutor(1) as reader:
+        for i, filename in enumerate(filenames):
+            if i == 0:
+                upcoming = reader.submit(_read_file, filename)
+            content = upcoming.result()
+            if i + 1 < len(filenames):
+                upcoming = reader.submit(_read_file, filenames[i + 1])
+            results.append(_parse_imports(content, filename))
+    return results
+
+
+# what reading a cache which is corrupt, or was written by another version
+# of Python (or dbm module), can raise: all taken to mean nothing's cached
+# (dbm.error covers OSError; dbm.dumb's index is a Python literal)
+_CACHE_ERRORS = dbm.error + (EOFError, ValueError, TypeError, SyntaxError)
+
+
+class _ScanCache:
+    '''Remembers the imports found in each file between runs, so files which
+    haven't changed (going by their size and modification time) don't have
+    to be parsed again.
+    '''
+    def __init__(self, directory):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self.__db = dbm.open(os.path.join(directory, 'imports'), 'c')
+        except _CACHE_ERRORS as e:
+            # unreadable, or locked by another run sharing it (dbm.gnu only
+            # lets one have it open): do without, as the run would have
+            log.debug('not using the scan cache: %s', e)
+            self.__db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.__db is not None:
+            try:
+                self.__db.close()
+            except _CACHE_ERRORS:
+                pass
+
+    def scan(self, filenames, jobs):
+        if self.__db is None:
+            return _scan_files(filenames, jobs)
+
+        # stamp the files before reading them so that a file changed while
+        # we're scanning it is scanned again next time
+        stamps = []
+        for filename in filenames:
+            st = os.stat(filename)
+            stamps.append((__version__, st.st_mtime_ns, st.st_size))
+
+        results = []
+        stale = []
+        for i, filename in enumerate(filenames):
+            try:
+                stamp, imports = marshal.loads(
+                    self.__db[os.fsencode(filename)])
+            except (KeyError,) + _CACHE_ERRORS:
+                # not cached, or a bad entry: one more file to scan either way
+                stamp = None
+            if stamp == stamps[i]:
+                results.append(imports)
+                continue
+            results.append(None)
+            stale.append(i)
+
+        scanned = _scan_files([filenames[i] for i in stale], jobs)
+        for i, imports in zip(stale, scanned):
+            results[i] = imports
+        try:
+            for i in stale:
+                self.__db[os.fsencode(filenames[i])] = marshal.dumps(
+                    (stamps[i], results[i]))
+        except _CACHE_ERRORS as e:
+            # the results are good, they just won't be remembered
+            log.debug('not updating the scan cache: %s', e)
+        return results
+
+
+def add_scan_options(parser):
+    '''Adds the options, shared by both commands, which say how the source
+    files are scanned.
+    '''
+    parser.add_option("--scan-all-dirs", dest="scan_all_dirs",
+        action="store_true", default=False,
+        help="also scan hidden, __pycache__, node_modules, site-packages, "
+            "venv and *.egg-info directories")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+        help="number of processes used to parse source files "
+            "(0 for one per CPU)")
+    parser.add_option("--cache-dir", dest="cache_dir", default=None,
+        help="directory to keep scan results in between runs")
+
+
+def check_scan_options(parser, options):
+    '''Validates the options added by add_scan_options, filling in the
+    number of jobs.
+    '''
+    if options.jobs < 0:
+        parser.error("--jobs can't be negative")
+        sys.exit(2)
+    if options.jobs == 0:
+        options.jobs = os.cpu_count() or 1
 
 
 def find_imported_modules(options):
-    vis = ImportVisitor(options)
+    # start from a clean slate: importlib's finders cache directory
+    # listings, which may be out of date if files were just installed
+    importlib.invalidate_caches()
+    _locate.cache_clear()
+    _resolve_module.cache_clear()
+    # relpath() would otherwise call getcwd() for every file we log
+    cwd = os.getcwd()
+    info = log.isEnabledFor(logging.INFO)
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    # a glob like "tests/*" covers everything under the directory, so rule
+    # it out up front rather than walking it just to ignore each file (a
+    # plain function can't tell us that, so then nothing is ruled out)
+    ignores_dir = getattr(options.ignore_files, 'ignores_dir', None)
+
+    def skip_dir(path):
+        if not options.scan_all_dirs and skipped_dir(path):
+            return True
+        if ignores_dir is not None and ignores_dir(path):
+            if info:
+                log.info('ignoring: %s%s', os.path.relpath(path, cwd), os.sep)
+            return True
+        return False
+
+    filenames = []
+    # overlapping paths ("src" and "src/pkg", or a symlink to it) would
+    # otherwise have the same files parsed, and their imports reported,
+    # twice; symlinked directories aren't followed, so resolving each root
+    # once is enough to tell where every file under it really is - bar the
+    # files which are symlinks themselves
+    seen = set()
     for path in options.paths:
-        for filename in pyfiles(path):
+        root = os.path.abspath(path).rstrip(os.sep)
+        real_root = os.path.realpath(path).rstrip(os.sep)
+        for filename, is_link in _pyfiles(path, skip_dir):
+            if is_link:
+                real_filename = os.path.realpath(filename)
+            else:
+                real_filename = real_root + filename[len(root):]
+            if real_filename in seen:
+                continue
+            seen.add(real_filename)
             if options.ignore_files(filename):
-                log.info('ignoring: %s', os.path.relpath(filename))
+                if info:
+                    log.info('ignoring: %s', os.path.relpath(filename, cwd))
                 continue
-            log.debug('scanning: %s', os.path.relpath(filename))
-            with open(filename) as f:
-                content = f.read()
-            vis.set_location(filename)
-            vis.visit(ast.parse(content))
+            filenames.append(filename)
+
+    if options.cache_dir:
+        with _ScanCache(options.cache_dir) as cache:
+            scanned = cache.scan(filenames, options.jobs)
+    else:
+        scanned = _scan_files(filenames, options.jobs)
+
+    vis = ImportVisitor(options)
+    for filename, imports in zip(filenames, scanned):
+        if debug:
+            log.debug('scanning: %s', os.path.relpath(filename, cwd))
+        vis.set_location(filename)
+        for modname, lineno in imports:
+            vis.add_module(modname, lineno)
     return vis.finalise()
 
 
-def find_required_modules(options):
-    explicit = set()
+# what most requirements files are made of: a name, maybe with extras,
+# version specifiers and environment markers
+_SIMPLE_REQUIREMENT = re.compile(r'''
+    \s*([A-Za-z0-9](?:[A-Za-z0-9._-]*[A-Za-z0-9])?)     # name
+    \s*(?:\[[\w.,\s-]*\])?                             # [extras]
+    \s*(?:(?:===|[<>!=~]=|[<>])\s*[\w.*+!-]+            # specifiers
+        (?:\s*,\s*(?:===|[<>!=~]=|[<>])\s*[\w.*+!-]+)*)?
+    \s*(?:;[^#]*)?                                      # ; markers
+    $''', re.VERBOSE)
+# as pip has it: a comment starts the line or follows some whitespace
+_COMMENT = re.compile(r'(^|\s+)#.*$')
+# ... and "name"s with these endings are files to install
+_ARCHIVE_EXTENSIONS = ('.zip', '.whl', '.tar', '.tar.gz', '.tgz', '.tar.bz2',
+    '.tbz', '.tar.xz', '.txz', '.tar.lz', '.tlz', '.tar.lzma')
+
+_Requirement = collections.namedtuple('_Requirement', ['name'])
+
+
+def _simple_requirements(filename):
+    '''The names in the requirements file, when all it holds are simple
+    requirements - or None if there's anything else (options, URLs,
+    includes, continued lines...) which needs pip's parser.
+    '''
+    try:
+        with open(filename, encoding='utf-8-sig') as f:
+            lines = f.read().splitlines()
+    except (OSError, UnicodeDecodeError):
+        # let pip have a go (and complain about it)
+        return None
+    names = []
+    for line in lines:
+        if line.endswith('\\'):
+            return None
+        line = _COMMENT.sub('', line)
+        if not line or line.isspace():
+            continue
+        match = _SIMPLE_REQUIREMENT.match(line)
+        if match is None or match.group(1).lower().endswith(
+                _ARCHIVE_EXTENSIONS):
+            return None
+        names.append(match.group(1))
+    return names
+
+
+@functools.lru_cache(maxsize=None)
+def _session():
+    '''A PipSession for reading requirements files. They're local files, so
+    one session (which is costly to set up) does for the whole process.
+    '''
+    from pip._internal.network.session import PipSession
+    return PipSession()
+
+
+def requirements():
+    '''Yields each requirement in requirements.txt as an install requirement
+    (so with a name), however this version of pip parses them.
+    '''
+    # pip's parser (and the session it needs) is slow to set up, and
+    # overkill for a plain list of names
+    names = _simple_requirements('requirements.txt')
+    if names is not None:
+        for name in names:
+            yield _Requirement(name)
+        return
+
+    from pip._internal.req.constructors import install_req_from_line
+    from pip._internal.req.req_file import parse_requirements
+
     for requirement in parse_requirements('requirements.txt',
-            session=PipSession()):
+            session=_session()):
         if not hasattr(requirement, "name"):
-            from pip._internal.req.constructors import install_req_from_line
             requirement = install_req_from_line(requirement.requirement)
+        yield requirement
+
+
+def find_required_modules(options):
+    debug = log.isEnabledFor(logging.DEBUG)
+    explicit = set()
+    for requirement in requirements():
         if options.ignore_reqs(requirement):
-            log.debug('ignoring requirement: %s', requirement.name)
+            if debug:
+                log.debug('ignoring requirement: %s', requirement.name)
         else:
-            log.debug('found requirement: %s', requirement.name)
+            if debug:
+                log.debug('found requirement: %s', requirement.name)
             explicit.add(canonicalize_name(requirement.name))
     return explicit
 
 
+_PACKAGE_FILES = frozenset(['__init__.py', '__init__.pyc', '__init__.pyo'])
+
+
 def is_package_file(path):
     '''Determines whether the path points to a Python package sentinel
     file - the __init__.py or its compiled variants.
     '''
-    m = re.search('(.+)/__init__\.py[co]?$', path)
-    if m is not None:
-        return m.group(1)
+    # this is called for every installed file, so avoid the regex engine;
+    # os.path also copes with Windows separators
+    package, name = os.path.split(path)
+    if name in _PACKAGE_FILES and os.path.basename(package):
+        return package
     return ''
 
 
+_GLOB_CHARS = re.compile(r'[*?[]')
+
+
 def ignorer(ignore_cfg):
     if not ignore_cfg:
-        return lambda candidate: False
-
-    def f(candidate, ignore_cfg=ignore_cfg):
-        for ignore in ignore_cfg:
-            if fnmatch.fnmatch(candidate, ignore):
-                return True
-            elif fnmatch.fnmatch(os.path.relpath(candidate), ignore):
-                return True
-        return False
+        def f(candidate):
+            return False
+        f.ignores_dir = f
+        return f
+
+    # most patterns are plain names, "*.ext" or "dir/*", which plain string
+    # comparisons handle much more cheaply than a regular expression
+    suffixes = []
+    prefixes = []
+    literals = set()
+    globs = []
+    # a pattern ending in "*" which matches a directory (with its trailing
+    # separator) matches everything under it too
+    dir_globs = []
+    for ignore in ignore_cfg:
+        ignore = os.path.normcase(ignore)
+        if not _GLOB_CHARS.search(ignore):
+            literals.add(ignore)
+        elif ignore[0] == '*' and not _GLOB_CHARS.search(ignore, 1):
+            suffixes.append(ignore[1:])
+        elif ignore[-1] == '*' and not _GLOB_CHARS.search(ignore, 0,
+                len(ignore) - 1):
+            prefixes.append(ignore[:-1])
+            continue
+        else:
+            globs.append(ignore)
+        if ignore[-1] == '*':
+            dir_globs.append(ignore)
+    suffixes = tuple(suffixes)
+    prefixes = tuple(prefixes)
+
+    # translate the rest into one regular expression up front rather than
+    # having fnmatch look up each one again for every candidate
+    match = None
+    if globs:
+        match = re.compile('|'.join(fnmatch.translate(ignore)
+            for ignore in globs)).match
+    match_dir = None
+    if dir_globs:
+        match_dir = re.compile('|'.join(fnmatch.translate(ignore)
+            for ignore in dir_globs)).match
+
+    def matches(path):
+        if path.endswith(suffixes) or path.startswith(prefixes):
+            return True
+        if path in literals:
+            return True
+        return match is not None and match(path) is not None
+
+    def covers(directory):
+        if directory.startswith(prefixes):
+            return True
+        return match_dir is not None and match_dir(directory) is not None
+
+    # the same candidates come up again and again (every file importing
+    # os asks about os) so don't keep recomputing their relative paths
+    cwd = os.getcwd()
+
+    @functools.lru_cache(maxsize=4096)
+    def relpath(candidate):
+        return os.path.normcase(os.path.relpath(candidate, cwd))
+
+    def f(candidate):
+        # requirements are matched by name
+        candidate = getattr(candidate, 'name', candidate)
+        if matches(os.path.normcase(candidate)):
+            return True
+        # module and requirement names (and relative paths) are already
+        # relative, so only paths get a second try against the cwd
+        if not os.path.isabs(candidate):
+            return False
+        return matches(relpath(candidate))
+
+    def ignores_dir(path):
+        '''Whether every file under the directory is ignored.'''
+        if covers(os.path.normcase(path) + os.sep):
+            return True
+        if not os.path.isabs(path):
+            return False
+        return covers(relpath(path) + os.sep)
+    f.ignores_dir = ignores_dir
     return f
 
 
-def search_packages_info(query):
-    """
-    Gather details from installed distributions. Print distribution name,
-    version, location, and installed files. Installed files requires a
-    pip generated 'installed-files.txt' in the distributions '.egg-info'
-    directory.
-    """
-    installed = {}
-    for p in pkg_resources.working_set:
-        installed[canonicalize_name(p.project_name)] = p
-
-    query_names = [canonicalize_name(name) for name in query]
-
-    for dist in [installed[pkg] for pkg in query_names if pkg in installed]:
-        package = {
-            'name': dist.project_name,
-            'version': dist.version,
-            'location': dist.location,
-            'requires': [dep.project_name for dep in dist.requires()],
-        }
-        file_list = None
-        if isinstance(dist, pkg_resources.DistInfoDistribution):
-            # RECORDs should be part of .dist-info metadatas
-            if dist.has_metadata('RECORD'):
-                lines = dist.get_metadata_lines('RECORD')
-                paths = [l.split(',')[0] for l in lines]
-                paths = [os.path.join(dist.location, p) for p in paths]
-                file_list = [os.path.relpath(p, dist.location) for p in paths]
-        else:
-            # Otherwise use pip's log for .egg-info's
-            if dist.has_metadata('installed-files.txt'):
-                paths = dist.get_metadata_lines('installed-files.txt')
-                paths = [os.path.join(dist.egg_info, p) for p in paths]
-                file_list = [os.path.relpath(p, dist.location) for p in paths]
-
-        if file_list:
-            package['files'] = sorted(file_list)
-        yield package
+def _package_info(dist):
+    '''The name, location and installed files of one distribution. The
+    files are only known from a RECORD (.dist-info) or a pip generated
+    installed-files.txt (.egg-info).
+    '''
+    import pkg_resources
+
+    # (the version and requirements aren't needed, and reading them
+    # means parsing each distribution's METADATA)
+    package = {
+        'name': dist.project_name,
+        'location': dist.location,
+    }
+    file_list = None
+    if isinstance(dist, pkg_resources.DistInfoDistribution):
+        # RECORDs should be part of .dist-info metadatas
+        if dist.has_metadata('RECORD'):
+            lines = dist.get_metadata_lines('RECORD')
+            file_list = sorted(
+                os.path.relpath(
+                    os.path.join(dist.location, line.split(',', 1)[0]),
+                    dist.location)
+                for line in lines)
+    else:
+        # Otherwise use pip's log for .egg-info's
+        if dist.has_metadata('installed-files.txt'):
+            lines = dist.get_metadata_lines('installed-files.txt')
+            file_list = sorted(
+                os.path.relpath(os.path.join(dist.egg_info, line),
+                    dist.location)
+                for line in lines)
+
+    if file_list:
+        package['files'] = file_list
+    return package
+
+
+def _packages_stamp():
+    # installing or removing a distribution adds or removes entries in a
+    # sys.path directory, which changes that directory's modification time
+    stamp = [__version__]
+    for entry in sys.path:
+        try:
+            stamp.append((entry, os.stat(entry or os.curdir).st_mtime_ns))
+        except OSError:
+            stamp.append((entry, None))
+    return stamp
+
+
+@functools.lru_cache(maxsize=None)
+def installed_packages(cache_dir=None):
+    '''
+    Details of every installed distribution, as from _package_info.
+    Reading all that metadata is slow and it won't change while we're
+    running, so it's only done once per process - and given a cache_dir,
+    only again once something has been installed or removed.
+    '''
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, 'packages')
+        # stamp before reading so that an install part way through the
+        # run is picked up next time
+        stamp = _packages_stamp()
+        try:
+            with open(filename, 'rb') as f:
+                cached_stamp, packages = marshal.load(f)
+            if cached_stamp == stamp:
+                return packages
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    import pkg_resources
+
+    # project_name comes from the metadata directory's name, so telling the
+    # distributions apart doesn't open any of their metadata; names which
+    # only differ in spelling ("foo.bar", "foo-bar") are only read once
+    packages = []
+    seen = set()
+    for dist in pkg_resources.working_set:
+        key = canonicalize_name(dist.project_name)
+        if key and key not in seen:
+            seen.add(key)
+            packages.append(_package_info(dist))
+    packages = tuple(packages)
+
+    if cache_dir is not None:
+        # write a new file and move it into place, so that a run sharing the
+        # cache never reads one half written
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile('wb', dir=cache_dir,
+                    prefix='packages.', delete=False) as f:
+                marshal.dump((stamp, packages), f)
+            os.replace(f.name, filename)
+        except OSError as e:
+            # the details are good, they just won't be remembered
+            log.debug('not updating the package cache: %s', e)
+    return packages
+
+
+def installed_files(used_modules, options):
+    '''Maps each file the used modules resolved to onto the name of the
+    installed distribution which provides it. Only those files matter, so
+    nothing else installed is indexed.
+    '''
+    debug = log.isEnabledFor(logging.DEBUG)
+    wanted = set(info.filename for info in used_modules.values())
+    found = {}
+    resolved = {}
+    for package in installed_packages(options.cache_dir):
+        if debug:
+            log.debug('installed package: %s (at %s)', package['name'],
+                package['location'])
+        for file in package.get('files', []) or []:
+            # the used modules' paths have their symlinks resolved, so these
+            # must be too - but only once for each top-level entry ("spam"
+            # for spam/__init__.py) rather than for every file under it
+            top, _, rest = file.partition(os.sep)
+            top = os.path.join(package['location'], top)
+            real_top = resolved.get(top)
+            if real_top is None:
+                real_top = resolved[top] = os.path.realpath(top)
+            path = os.path.normpath(os.path.join(real_top, rest))
+            if path in wanted:
+                found[path] = package['name']
+            package_path = is_package_file(path)
+            if package_path in wanted:
+                # we've seen a package file so add the bare package directory
+                # to the installed list as well as we might want to look up
+                # a package by its directory path later
+                found[package_path] = package['name']
+        if len(found) == len(wanted):
+            # every used module has been accounted for
+            break
+    return found
@@ -1,14 +1,8 @@
-import collections
 import logging
 import optparse
-import os
 import sys
 
-from packaging.utils import canonicalize_name
-#from pip._internal.commands.show import search_packages_info
-from pip._internal.utils.misc import get_installed_distributions
 from pip_check_reqs import common
-from pip_check_reqs.common import search_packages_info
 
 log = logging.getLogger(__name__)
 
@@ -17,36 +11,27 @@ def find_extra_reqs(options):
     # 1. find files used by imports in the code (as best we can without
     #    executing)
     used_modules = common.find_imported_modules(options)
+    debug = log.isEnabledFor(logging.DEBUG)
 
     # 2. find which packages provide which files
-    installed_files = {}
-    all_pkgs = (pkg.project_name for pkg in get_installed_distributions())
-    for package in search_packages_info(all_pkgs):
-        log.debug('installed package: %s (at %s)', package['name'],
-            package['location'])
-        for f in package.get('files', []):
-            path = os.path.realpath(os.path.join(package['location'], f))
-            installed_files[path] = package['name']
-            package_path = common.is_package_file(path)
-            if package_path:
-                # we've seen a package file so add the bare package directory
-                # to the installed list as well as we might want to look up
-                # a package by its directory path later
-                installed_files[package_path] = package['name']
-
-    # 3. match imported modules against those packages
-    used = collections.defaultdict(list)
+    installed_files = common.installed_files(used_modules, options)
+
+    # 3. match imported modules against those packages - all that matters
+    #    is which packages are used, not where
+    used = set()
     for modname, info in used_modules.items():
-        # probably standard library if it's not in the files list
-        if info.filename in installed_files:
-            used_name = canonicalize_name(installed_files[info.filename])
+        package_name = installed_files.get(info.filename)
+        if package_name is None:
+            # probably standard library if it's not in the files list
+            if debug:
+                log.debug(
+                    'used module: %s (from file %s, assuming stdlib or local)',
+                    modname, info.filename)
+            continue
+        if debug:
             log.debug('used module: %s (from package %s)', modname,
-                installed_files[info.filename])
-            used[used_name].append(info)
-        else:
-            log.debug(
-                'used module: %s (from file %s, assuming stdlib or local)',
-                modname, info.filename)
+                package_name)
+        used.add(common.canonicalize_name(package_name))
 
     # 4. compare with requirements.txt
     explicit = common.find_required_modules(options)
@@ -68,6 +53,7 @@ def main():
     parser.add_option("-r", "--ignore-requirement", dest="ignore_reqs",
         action="append", default=[],
         help="reqs in requirements.txt to ignore")
+    common.add_scan_options(parser)
     parser.add_option("-v", "--verbose", dest="verbose",
         action="store_true", default=False, help="be more verbose")
     parser.add_option("-d", "--debug", dest="debug",
@@ -84,6 +70,8 @@ def main():
         parser.error("no source files or directories specified")
         sys.exit(2)
 
+    common.check_scan_options(parser, options)
+
     options.ignore_files = common.ignorer(options.ignore_files)
     options.ignore_mods = common.ignorer(options.ignore_mods)
     options.ignore_reqs = common.ignorer(options.ignore_reqs)
@@ -104,8 +92,8 @@ def main():
 
     if extras:
         log.warning('Extra requirements:')
-    for name in extras:
-        log.warning('%s in requirements.txt' % name)
+        log.warning('\n'.join('%s in requirements.txt' % name
+            for name in extras))
 
     if extras:
         sys.exit(1)
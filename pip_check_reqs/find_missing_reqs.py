@@ -1,21 +1,9 @@
-import collections
 import logging
 import optparse
 import os
 import sys
 
-from packaging.utils import canonicalize_name
-#from pip._internal.commands.show import search_packages_info
-try:
-    from pip._internal.network.session import PipSession
-except ImportError:
-    from pip._internal.download import PipSession
-
-from pip._internal.req.req_file import parse_requirements
-from pip._internal.utils.misc import get_installed_distributions
-
 from pip_check_reqs import common
-from pip_check_reqs.common import search_packages_info
 
 log = logging.getLogger(__name__)
 
@@ -24,49 +12,40 @@ def find_missing_reqs(options):
     # 1. find files used by imports in the code (as best we can without
     #    executing)
     used_modules = common.find_imported_modules(options)
+    debug = log.isEnabledFor(logging.DEBUG)
 
     # 2. find which packages provide which files
-    installed_files = {}
-    all_pkgs = (pkg.project_name for pkg in get_installed_distributions())
-    for package in search_packages_info(all_pkgs):
-        log.debug('installed package: %s (at %s)', package['name'],
-            package['location'])
-        for file in package.get('files', []) or []:
-            path = os.path.realpath(os.path.join(package['location'], file))
-            installed_files[path] = package['name']
-            package_path = common.is_package_file(path)
-            if package_path:
-                # we've seen a package file so add the bare package directory
-                # to the installed list as well as we might want to look up
-                # a package by its directory path later
-                installed_files[package_path] = package['name']
+    installed_files = common.installed_files(used_modules, options)
 
     # 3. match imported modules against those packages
-    used = collections.defaultdict(list)
+    used = {}
     for modname, info in used_modules.items():
-        # probably standard library if it's not in the files list
-        if info.filename in installed_files:
-            used_name = canonicalize_name(installed_files[info.filename])
+        package_name = installed_files.get(info.filename)
+        if package_name is None:
+            # probably standard library if it's not in the files list
+            if debug:
+                log.debug(
+                    'used module: %s (from file %s, assuming stdlib or local)',
+                    modname, info.filename)
+            continue
+        if debug:
             log.debug('used module: %s (from package %s)', modname,
-                installed_files[info.filename])
-            used[used_name].append(info)
+                package_name)
+        used_name = common.canonicalize_name(package_name)
+        uses = used.get(used_name)
+        if uses is None:
+            used[used_name] = [info]
         else:
-            log.debug(
-                'used module: %s (from file %s, assuming stdlib or local)',
-                modname, info.filename)
+            uses.append(info)
 
     # 4. compare with requirements.txt
     explicit = set()
-    for requirement in parse_requirements('requirements.txt',
-            session=PipSession()):
-        if not hasattr(requirement, "name"):
-            from pip._internal.req.constructors import install_req_from_line
-            requirement = install_req_from_line(requirement.requirement)
-
-        log.debug('found requirement: %s', requirement.name)
-        explicit.add(canonicalize_name(requirement.name))
+    for requirement in common.requirements():
+        if debug:
+            log.debug('found requirement: %s', requirement.name)
+        explicit.add(common.canonicalize_name(requirement.name))
 
-    return [(name, used[name]) for name in used
+    return [(name, uses) for name, uses in used.items()
         if name not in explicit]
 
 
@@ -81,6 +60,7 @@ def main():
     parser.add_option("-m", "--ignore-module", dest="ignore_mods",
         action="append", default=[],
         help="used module names (globs are ok) to ignore")
+    common.add_scan_options(parser)
     parser.add_option("-v", "--verbose", dest="verbose",
         action="store_true", default=False, help="be more verbose")
     parser.add_option("-d", "--debug", dest="debug",
@@ -97,6 +77,8 @@ def main():
         parser.error("no source files or directories specified")
         sys.exit(2)
 
+    common.check_scan_options(parser, options)
+
     options.ignore_files = common.ignorer(options.ignore_files)
     options.ignore_mods = common.ignorer(options.ignore_mods)
 
@@ -114,13 +96,19 @@ def main():
 
     missing = find_missing_reqs(options)
 
-    if missing:
+    if missing and log.isEnabledFor(logging.WARN):
+        # report every location in one record rather than paying for the
+        # logging machinery once per line
+        cwd = os.getcwd()
+        lines = []
+        for name, uses in missing:
+            for use in uses:
+                for filename, lineno in use.locations:
+                    lines.append('%s:%s dist=%s module=%s' % (
+                        os.path.relpath(filename, cwd), lineno, name,
+                        use.modname))
         log.warning('Missing requirements:')
-    for name, uses in missing:
-        for use in uses:
-            for filename, lineno in use.locations:
-                log.warning('%s:%s dist=%s module=%s',
-                    os.path.relpath(filename), lineno, name, use.modname)
+        log.warning('\n'.join(lines))
 
     if missing:
         sys.exit(1)
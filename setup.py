@@ -33,8 +33,8 @@ setup(
         'Intended Audience :: Developers',
         'Topic :: Software Development :: Build Tools',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
     packages=['pip_check_reqs'],
     entry_points={
@@ -43,5 +43,6 @@ setup(
             'pip-extra-reqs=pip_check_reqs.find_extra_reqs:main',
         ],
     },
-    install_requires=requirements
+    install_requires=requirements,
+    python_requires='>=3.6',
 )
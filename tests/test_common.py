@@ -2,16 +2,33 @@ from __future__ import absolute_import
 
 import ast
 import collections
+import dbm
 import logging
+import optparse
 import os.path
 import sys
 
+import pkg_resources
 import pytest
 import pretend
 
 from pip_check_reqs import common
 
 
+@pytest.fixture
+def scan_options():
+    '''Makes the options find_imported_modules is given, as main() would,
+    scanning the paths and ignoring nothing unless told otherwise.
+    '''
+    def make(paths, **overrides):
+        options = dict(paths=paths, jobs=1, scan_all_dirs=False,
+            cache_dir=None, ignore_files=common.ignorer([]),
+            ignore_mods=common.ignorer([]))
+        options.update(overrides)
+        return optparse.Values(options)
+    return make
+
+
 @pytest.mark.parametrize(["path", "result"], [
     ('/', ''),
     ('__init__.py', ''),    # a top-level file like this has no package name
@@ -21,6 +38,8 @@ from pip_check_reqs import common
     ('spam/__init__.pyo', 'spam'),
     ('ham/spam/__init__.py', 'ham/spam'),
     ('/ham/spam/__init__.py', '/ham/spam'),
+    ('/ham/spam/eggs.py', ''),
+    ('/ham/spam/not__init__.py', ''),
 ])
 def test_is_package_file(path, result):
     assert common.is_package_file(path) == result
@@ -53,6 +72,29 @@ def test_ImportVisitor(stmt, result):
     assert set(result.keys()) == set(result)
 
 
+def test_ImportVisitor_nested():
+    collector = common._ImportCollector()
+    collector.visit(ast.parse('''\
+import ast
+def spam():
+    import ham
+class Eggs:
+    if True:
+        import bacon
+    else:
+        from os import path
+try:
+    import sausage
+except ImportError:
+    import lobster
+finally:
+    with spam():
+        import thermidor
+'''))
+    assert collector.imports == [('ast', 1), ('ham', 3), ('bacon', 6),
+        ('os.path', 8), ('sausage', 10), ('lobster', 12), ('thermidor', 15)]
+
+
 def test_pyfiles_file(monkeypatch):
     monkeypatch.setattr(os.path, 'abspath',
         pretend.call_recorder(lambda x: '/spam/ham.py'))
@@ -68,20 +110,100 @@ def test_pyfiles_file_no_dice(monkeypatch):
         list(common.pyfiles('spam'))
 
 
-def test_pyfiles_package(monkeypatch):
-    monkeypatch.setattr(os.path, 'abspath',
-        pretend.call_recorder(lambda x: '/spam'))
-    monkeypatch.setattr(os.path, 'isdir',
-        pretend.call_recorder(lambda x: True))
-    walk_results = [
-        ('spam', [], ['__init__.py', 'spam', 'ham.py']),
-        ('spam/dub', [], ['bass.py', 'dropped']),
-    ]
-    monkeypatch.setattr(os, 'walk',
-        pretend.call_recorder(lambda x: walk_results))
+def test_pyfiles_package(tmpdir):
+    spam = tmpdir.mkdir('spam')
+    for name in ['__init__.py', 'spam', 'ham.py']:
+        spam.join(name).write('')
+    dub = spam.mkdir('dub')
+    for name in ['bass.py', 'dropped']:
+        dub.join(name).write('')
+
+    assert sorted(common.pyfiles(str(spam))) == sorted([
+        str(spam.join('__init__.py')),
+        str(spam.join('ham.py')),
+        str(dub.join('bass.py')),
+    ])
+
+
+def test_pyfiles_unlistable_dir(monkeypatch, tmpdir):
+    tmpdir.join('spam.py').write('')
+    locked = tmpdir.mkdir('locked')
+    locked.join('ham.py').write('')
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if path == str(locked):
+            raise PermissionError(13, 'Permission denied', path)
+        return scandir(path)
+    monkeypatch.setattr(os, 'scandir', fake_scandir)
+
+    assert list(common.pyfiles(str(tmpdir))) == [str(tmpdir.join('spam.py'))]
+
+
+@pytest.mark.parametrize(["name", "result"], [
+    ('spam', False),
+    ('.git', True),
+    ('.venv', True),
+    ('__pycache__', True),
+    ('node_modules', True),
+    ('venv', True),
+    ('site-packages', True),
+    ('spam.egg-info', True),
+    ('build', False),
+    ('/spam/.git', True),
+    ('/.git/spam', False),
+])
+def test_skipped_dir(name, result):
+    assert common.skipped_dir(name) == result
+
+
+def test_pyfiles_only_files(tmpdir):
+    tmpdir.join('spam.py').write('')
+    tmpdir.join('ham.py').mksymlinkto(tmpdir.join('spam.py'))
+    tmpdir.join('eggs.py').mksymlinkto(tmpdir.mkdir('eggs'))
+    tmpdir.join('bacon.py').mksymlinkto(tmpdir.join('missing.py'))
+
+    assert sorted(common.pyfiles(str(tmpdir))) == [
+        str(tmpdir.join('ham.py')), str(tmpdir.join('spam.py'))]
+
+
+def test_pyfiles_skip_dir(tmpdir):
+    tmpdir.join('spam.py').write('')
+    tmpdir.mkdir('.tox').join('ham.py').write('')
+    tmpdir.mkdir('eggs').join('ham.py').write('')
 
-    assert list(common.pyfiles('spam')) == \
-        ['spam/__init__.py', 'spam/ham.py', 'spam/dub/bass.py']
+    assert sorted(common.pyfiles(str(tmpdir), skip_dir=common.skipped_dir)) \
+        == [str(tmpdir.join('eggs', 'ham.py')), str(tmpdir.join('spam.py'))]
+    assert len(list(common.pyfiles(str(tmpdir)))) == 3
+
+
+def test_scan_options(monkeypatch):
+    parser = optparse.OptionParser()
+    common.add_scan_options(parser)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 3)
+
+    options, args = parser.parse_args([])
+    common.check_scan_options(parser, options)
+    assert (options.jobs, options.cache_dir, options.scan_all_dirs) == \
+        (1, None, False)
+
+    # no number of jobs means one per CPU
+    options, args = parser.parse_args(['-j', '0', '--cache-dir', 'cache',
+        '--scan-all-dirs'])
+    common.check_scan_options(parser, options)
+    assert (options.jobs, options.cache_dir, options.scan_all_dirs) == \
+        (3, 'cache', True)
+
+
+def test_scan_options_negative_jobs(capsys):
+    parser = optparse.OptionParser()
+    common.add_scan_options(parser)
+    options, args = parser.parse_args(['--jobs', '-1'])
+
+    with pytest.raises(SystemExit) as excinfo:
+        common.check_scan_options(parser, options)
+    assert excinfo.value.code == 2
+    assert "--jobs can't be negative" in capsys.readouterr().err
 
 
 @pytest.mark.parametrize(["ignore_ham", "ignore_hashlib", "expect", "locs"], [
@@ -92,8 +214,11 @@ def test_pyfiles_package(monkeypatch):
 ])
 def test_find_imported_modules(monkeypatch, caplog, ignore_ham, ignore_hashlib,
         expect, locs):
-    monkeypatch.setattr(common, 'pyfiles',
-        pretend.call_recorder(lambda x: ['spam.py', 'ham.py']))
+    # (like pyfiles, which gives absolute paths under the root)
+    monkeypatch.setattr(common, '_pyfiles',
+        pretend.call_recorder(lambda x, skip_dir: [
+            (os.path.abspath('spam.py'), False),
+            (os.path.abspath('ham.py'), False)]))
 
     if sys.version_info[0] == 2:
         # py2 will find sys module but py3k won't
@@ -101,13 +226,13 @@ def test_find_imported_modules(monkeypatch, caplog, ignore_ham, ignore_hashlib,
 
     class FakeFile():
         contents = [
-            'from os import path\nimport ast, hashlib',
-            'from __future__ import braces\nimport ast, sys\n'
-            'from . import friend',
+            b'from os import path\nimport ast, hashlib',
+            b'from __future__ import braces\nimport ast, sys\n'
+            b'from . import friend',
         ]
 
-        def __init__(self, filename):
-            pass
+        def __init__(self, filename, mode='r'):
+            assert mode == 'rb'
 
         def read(self):
             return self.contents.pop()
@@ -122,12 +247,15 @@ def test_find_imported_modules(monkeypatch, caplog, ignore_ham, ignore_hashlib,
     caplog.set_level(logging.INFO)
 
     class options:
-        paths = ['dummy']
+        paths = ['.']
         verbose = True
+        jobs = 1
+        scan_all_dirs = False
+        cache_dir = None
 
         @staticmethod
         def ignore_files(path):
-            if path == 'ham.py' and ignore_ham:
+            if path == os.path.abspath('ham.py') and ignore_ham:
                 return True
             return False
 
@@ -139,12 +267,145 @@ def test_find_imported_modules(monkeypatch, caplog, ignore_ham, ignore_hashlib,
 
     result = common.find_imported_modules(options)
     assert set(result) == set(expect)
-    assert result['ast'].locations == locs
+    assert result['ast'].locations == [
+        (os.path.abspath(filename), lineno) for filename, lineno in locs]
 
     if ignore_ham:
         assert caplog.records[0].message == 'ignoring: ham.py'
 
 
+def test_parse_imports_without_imports(monkeypatch):
+    monkeypatch.setattr(ast, 'parse', pretend.raiser(AssertionError))
+    assert common._parse_imports(b'spam = "ham"\n', 'spam.py') == []
+
+
+def test_find_imported_modules_in_parallel(tmpdir, scan_options):
+    tmpdir.join('spam.py').write('import ast\nfrom os import path\n')
+    tmpdir.join('ham.py').write('import spam_not_installed\nimport ast\n')
+    options = scan_options([str(tmpdir)], jobs=2)
+
+    result = common.find_imported_modules(options)
+    assert set(result) == set(['ast', 'os'])
+    assert sorted(result['ast'].locations) == [
+        (str(tmpdir.join('ham.py')), 2), (str(tmpdir.join('spam.py')), 1)]
+
+
+def test_find_imported_modules_ignored_dir(monkeypatch, tmpdir,
+        scan_options):
+    tmpdir.join('spam.py').write('import ast\n')
+    tmpdir.mkdir('tests').join('test_spam.py').write('import os\n')
+    scandir = pretend.call_recorder(os.scandir)
+    monkeypatch.setattr(os, 'scandir', scandir)
+    options = scan_options([str(tmpdir)],
+        ignore_files=common.ignorer([str(tmpdir) + '/tests/*']))
+
+    assert set(common.find_imported_modules(options)) == set(['ast'])
+    assert scandir.calls == [pretend.call(str(tmpdir))]
+
+
+def test_find_imported_modules_ignored_dir_relative(monkeypatch, tmpdir,
+        scan_options):
+    tmpdir.join('spam.py').write('import ast\n')
+    tmpdir.mkdir('tests').join('test_spam.py').write('import os\n')
+    monkeypatch.chdir(tmpdir)
+    scandir = pretend.call_recorder(os.scandir)
+    monkeypatch.setattr(os, 'scandir', scandir)
+    options = scan_options([str(tmpdir)],
+        ignore_files=common.ignorer(['tests/*']))
+
+    assert set(common.find_imported_modules(options)) == set(['ast'])
+    assert scandir.calls == [pretend.call(str(tmpdir))]
+
+
+@pytest.mark.parametrize("ignore", ['src/tests', '*tests', '*/tests'])
+def test_find_imported_modules_ignored_dir_name(monkeypatch, tmpdir,
+        scan_options, ignore):
+    source = tmpdir.mkdir('src')
+    source.mkdir('tests').join('test_spam.py').write('import ast\n')
+    monkeypatch.chdir(tmpdir)
+    options = scan_options(['src'], ignore_files=common.ignorer([ignore]))
+
+    # these only match a file called tests, not what's in a directory
+    result = common.find_imported_modules(options)
+    assert result['ast'].locations == [
+        (str(source.join('tests', 'test_spam.py')), 1)]
+
+
+def test_find_imported_modules_overlapping_paths(tmpdir, scan_options):
+    source = tmpdir.mkdir('src')
+    source.mkdir('pkg').join('spam.py').write('import ast\n')
+    options = scan_options([str(source), str(source.join('pkg'))])
+
+    result = common.find_imported_modules(options)
+    assert result['ast'].locations == [
+        (str(source.join('pkg', 'spam.py')), 1)]
+
+
+def test_find_imported_modules_symlinked_paths(tmpdir, scan_options):
+    source = tmpdir.mkdir('src')
+    source.mkdir('pkg').join('spam.py').write('import ast\n')
+    tmpdir.join('link').mksymlinkto(source.join('pkg'))
+    options = scan_options([str(source), str(tmpdir.join('link'))])
+
+    result = common.find_imported_modules(options)
+    assert result['ast'].locations == [
+        (str(source.join('pkg', 'spam.py')), 1)]
+
+
+def test_find_imported_modules_symlinked_file(tmpdir, scan_options):
+    source = tmpdir.mkdir('src')
+    source.join('spam.py').write('import ast\n')
+    source.join('ham.py').mksymlinkto(source.join('spam.py'))
+    options = scan_options([str(source)])
+
+    result = common.find_imported_modules(options)
+    assert len(result['ast'].locations) == 1
+
+
+def test_find_imported_modules_cached(monkeypatch, tmpdir, scan_options):
+    source = tmpdir.mkdir('src')
+    source.join('spam.py').write('import ast\n')
+    options = scan_options([str(source)], cache_dir=str(tmpdir.join('cache')))
+
+    assert set(common.find_imported_modules(options)) == set(['ast'])
+
+    # unchanged files come straight from the cache...
+    parse_imports = pretend.call_recorder(lambda content, filename: [])
+    monkeypatch.setattr(common, '_parse_imports', parse_imports)
+    assert set(common.find_imported_modules(options)) == set(['ast'])
+    assert parse_imports.calls == []
+
+    # ... but changed ones are scanned again
+    source.join('spam.py').write('import ast, os\n')
+    assert set(common.find_imported_modules(options)) == set()
+    assert parse_imports.calls == [
+        pretend.call(b'import ast, os\n', str(source.join('spam.py')))]
+
+
+def test_find_imported_modules_bad_cache(tmpdir, scan_options):
+    source = tmpdir.mkdir('src')
+    source.join('spam.py').write('import ast\n')
+    cache = tmpdir.mkdir('cache')
+    cache.join('imports').write_binary(b'garbage')
+    options = scan_options([str(source)], cache_dir=str(cache))
+
+    assert set(common.find_imported_modules(options)) == set(['ast'])
+
+
+def test_find_imported_modules_bad_cache_entry(tmpdir, scan_options):
+    source = tmpdir.mkdir('src')
+    source.join('spam.py').write('import ast\n')
+    cache = tmpdir.mkdir('cache')
+    with dbm.open(str(cache.join('imports')), 'c') as db:
+        db[os.fsencode(str(source.join('spam.py')))] = b'garbage'
+    options = scan_options([str(source)], cache_dir=str(cache))
+
+    assert set(common.find_imported_modules(options)) == set(['ast'])
+    # ... and the entry is put right
+    with dbm.open(str(cache.join('imports')), 'r') as db:
+        assert db[os.fsencode(str(source.join('spam.py')))] != b'garbage'
+
+
 @pytest.mark.parametrize(["ignore_cfg", "candidate", "result"], [
     ([], 'spam', False),
     ([], 'ham', False),
@@ -155,13 +416,68 @@ def test_find_imported_modules(monkeypatch, caplog, ignore_ham, ignore_hashlib,
     (['spam*'], 'spam.ham', True),
     (['spam*'], 'eggs', False),
     (['spam'], '/spam', True),
+    (['eggs', 'spam'], 'spam', True),
+    (['eggs', 'spam'], 'spam.ham', False),
+    (['eggs', 'spam*'], 'spam.ham', True),
+    (['spam', 'eggs*'], 'spam.ham', False),
+    (['eggs', 'spam'], '/spam', True),
+    (['*.py'], 'spam/ham.py', True),
+    (['*.py'], 'spam/ham.pyc', False),
+    (['*'], 'spam', True),
+    (['spam/*'], '/spam/ham.py', True),
+    (['spam/*'], 'eggs/spam/ham.py', False),
+    (['spam/*.py'], 'spam/ham.py', True),
+    (['spam/*.py'], 'spam/ham.txt', False),
+    (['*/spam/*'], 'eggs/spam/ham.py', True),
+    (['s?am/*'], 'spam/ham.py', True),
+    (['spam?'], 'spams', True),
+    (['*.txt', 'eggs', 's[pq]am'], 'sqam', True),
 ])
 def test_ignorer(monkeypatch, ignore_cfg, candidate, result):
-    monkeypatch.setattr(os.path, 'relpath', lambda s: s.lstrip('/'))
+    monkeypatch.setattr(os.path, 'relpath', lambda s, start: s.lstrip('/'))
     ignorer = common.ignorer(ignore_cfg)
     assert ignorer(candidate) == result
 
 
+@pytest.mark.parametrize(["ignore_cfg", "path", "result"], [
+    ([], 'spam', False),
+    (['spam'], 'spam', False),
+    (['spam*'], 'spam', True),
+    (['spam*'], 'spammy', True),
+    (['spam/*'], 'spam', True),
+    (['spam/*'], 'spam/ham', True),
+    (['spam/*'], '/spam', True),
+    (['spam/*'], 'eggs/spam', False),
+    (['spam/*.py'], 'spam', False),
+    (['*/spam/*'], 'eggs/spam', True),
+    (['*/spam/*'], 'eggs/spam/ham', True),
+    (['*/spam'], 'eggs/spam', False),
+    (['*spam'], 'spam', False),
+    (['*'], 'spam', True),
+])
+def test_ignorer_ignores_dir(monkeypatch, ignore_cfg, path, result):
+    monkeypatch.setattr(os.path, 'relpath', lambda s, start: s.lstrip('/'))
+    ignorer = common.ignorer(ignore_cfg)
+    assert ignorer.ignores_dir(path) == result
+
+
+def test_ignorer_relative(monkeypatch):
+    relpath = pretend.call_recorder(lambda s, start: s.lstrip('/'))
+    monkeypatch.setattr(os.path, 'relpath', relpath)
+    ignorer = common.ignorer(['spam/*'])
+    assert not ignorer('ham.eggs')
+    assert ignorer('/spam/ham.py')
+    assert relpath.calls == [pretend.call('/spam/ham.py', os.getcwd())]
+
+
+def test_ignorer_requirement(monkeypatch):
+    monkeypatch.setattr(os.path, 'relpath', lambda s, start: s.lstrip('/'))
+    FakeReq = collections.namedtuple('FakeReq', ['name'])
+    ignorer = common.ignorer(['spam*'])
+    assert ignorer(FakeReq('spam-eggs'))
+    assert not ignorer(FakeReq('ham'))
+
+
 def test_find_required_modules(monkeypatch):
     class options:
         @staticmethod
@@ -172,8 +488,232 @@ def test_find_required_modules(monkeypatch):
 
     FakeReq = collections.namedtuple('FakeReq', ['name'])
     requirements = [FakeReq('foobar'), FakeReq('barfoo')]
-    monkeypatch.setattr(common, 'parse_requirements',
-        pretend.call_recorder(lambda a, session=None: requirements))
+    monkeypatch.setattr(common, 'requirements', lambda: iter(requirements))
 
     reqs = common.find_required_modules(options)
     assert reqs == set(['foobar'])
+
+
+@pytest.mark.parametrize(["content", "result"], [
+    ('', []),
+    ('spam\n\n# a comment\nham  # another\n', ['spam', 'ham']),
+    ('Spam_Eggs[ham, bacon] >=1.0,<2.0.* ; python_version < "3.8"\n',
+        ['Spam_Eggs']),
+    ('spam===1.0+local\nham!=2!1.0.post1\n', ['spam', 'ham']),
+    ('spam\n-r other.txt\n', None),
+    ('-e .\n', None),
+    ('spam @ https://example.com/spam.zip\n', None),
+    ('spam.zip\n', None),
+    ('spam --hash=sha256:0123\n', None),
+    ('spam \\\n    >= 1.0\n', None),
+    ('${SPAM}\n', None),
+])
+def test_simple_requirements(tmpdir, content, result):
+    tmpdir.join('requirements.txt').write(content)
+    filename = str(tmpdir.join('requirements.txt'))
+    assert common._simple_requirements(filename) == result
+
+
+def test_simple_requirements_missing(tmpdir):
+    filename = str(tmpdir.join('requirements.txt'))
+    assert common._simple_requirements(filename) is None
+
+
+def test_requirements(monkeypatch, tmpdir):
+    tmpdir.join('requirements.txt').write('spam\nham >= 1.0\n')
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(common, '_session', pretend.raiser(AssertionError))
+    assert [req.name for req in common.requirements()] == ['spam', 'ham']
+
+
+def test_requirements_with_pip(monkeypatch, tmpdir):
+    tmpdir.join('requirements.txt').write('spam\n-r other.txt\n')
+    tmpdir.join('other.txt').write('ham >= 1.0\n')
+    monkeypatch.chdir(tmpdir)
+    assert [req.name for req in common.requirements()] == ['spam', 'ham']
+
+
+def test_ImportVisitor_caches_lookups(monkeypatch):
+    find_spec = pretend.call_recorder(lambda name, path: None)
+    monkeypatch.setattr(common.PathFinder, 'find_spec', find_spec)
+    common._locate.cache_clear()
+    common._resolve_module.cache_clear()
+
+    class options:
+        def ignore_mods(self, modname):
+            return False
+    vis = common.ImportVisitor(options())
+    vis.set_location('spam.py')
+    vis.visit(ast.parse('import spam\nimport spam\nimport spam.ham'))
+    assert vis.finalise() == {}
+    # spam.ham isn't looked for once spam is known to be missing
+    assert [call.args for call in find_spec.calls] == [('spam', None)]
+
+
+def test_ImportVisitor_same_line():
+    class options:
+        def ignore_mods(self, modname):
+            return False
+    vis = common.ImportVisitor(options())
+    vis.set_location('spam.py')
+    vis.visit(ast.parse('from ast import parse, walk\nimport ast'))
+    assert vis.finalise()['ast'].locations == [('spam.py', 1), ('spam.py', 2)]
+
+
+def test_ImportVisitor_ignores_each_name_once():
+    class options:
+        ignore_mods = staticmethod(pretend.call_recorder(
+            lambda modname: modname == 'ast'))
+    vis = common.ImportVisitor(options())
+    vis.set_location('spam.py')
+    vis.visit(ast.parse('import ast\nimport json\nimport ast, json'))
+    assert set(vis.finalise()) == set(['json'])
+    assert options.ignore_mods.calls == [
+        pretend.call('ast'), pretend.call('json')]
+
+
+def test_ImportVisitor_already_imported(monkeypatch):
+    find_spec = pretend.call_recorder(lambda name, path: None)
+    monkeypatch.setattr(common.PathFinder, 'find_spec', find_spec)
+    common._locate.cache_clear()
+    common._resolve_module.cache_clear()
+
+    assert common._resolve_module('ast.parse') == ('ast', ast.__file__)
+    assert find_spec.calls == []
+
+
+def test_installed_packages(monkeypatch):
+    FakeDist = collections.namedtuple('FakeDist', ['project_name'])
+    monkeypatch.setattr(pkg_resources, 'working_set',
+        [FakeDist('spam'), FakeDist('ham'), FakeDist('Spam')])
+    package_info = pretend.call_recorder(
+        lambda dist: dict(name=dist.project_name))
+    monkeypatch.setattr(common, '_package_info', package_info)
+    common.installed_packages.cache_clear()
+
+    try:
+        expected = (dict(name='spam'), dict(name='ham'))
+        assert common.installed_packages() == expected
+        assert common.installed_packages() == expected
+        assert len(package_info.calls) == 2
+    finally:
+        common.installed_packages.cache_clear()
+
+
+def test_installed_packages_cached(monkeypatch, tmpdir):
+    FakeDist = collections.namedtuple('FakeDist', ['project_name'])
+    monkeypatch.setattr(pkg_resources, 'working_set',
+        [FakeDist('spam')])
+    package_info = pretend.call_recorder(
+        lambda dist: dict(name=dist.project_name, files=['spam.py']))
+    monkeypatch.setattr(common, '_package_info', package_info)
+    site = tmpdir.mkdir('site')
+    monkeypatch.setattr(common.sys, 'path', [str(site)])
+    cache_dir = str(tmpdir.join('cache'))
+
+    try:
+        expected = (dict(name='spam', files=['spam.py']),)
+        for i in range(2):
+            common.installed_packages.cache_clear()
+            assert common.installed_packages(cache_dir) == expected
+        assert len(package_info.calls) == 1
+
+        # installing something changes the site directory
+        site.mkdir('ham-1.0.dist-info')
+        os.utime(str(site), ns=(0, 0))
+        common.installed_packages.cache_clear()
+        assert common.installed_packages(cache_dir) == expected
+        assert len(package_info.calls) == 2
+    finally:
+        common.installed_packages.cache_clear()
+
+
+def test_installed_files_symlinked_package(monkeypatch, tmpdir):
+    store = tmpdir.mkdir('store').mkdir('spam')
+    store.join('__init__.py').write('')
+    store.join('ham.py').write('')
+    site = tmpdir.mkdir('site')
+    site.join('spam').mksymlinkto(store)
+    packages = [dict(name='spam', location=str(site),
+        files=['spam/__init__.py', 'spam/ham.py'])]
+    monkeypatch.setattr(common, 'installed_packages',
+        lambda cache_dir: packages)
+    realpath = pretend.call_recorder(os.path.realpath)
+    monkeypatch.setattr(os.path, 'realpath', realpath)
+
+    used_modules = dict(
+        spam=common.FoundModule('spam', str(site.join('spam'))),
+        ham=common.FoundModule('spam.ham', str(site.join('spam', 'ham.py'))),
+    )
+    store = os.path.realpath(str(store))
+    realpath.calls[:] = []
+
+    class options:
+        cache_dir = None
+
+    assert common.installed_files(used_modules, options) == {
+        store: 'spam', os.path.join(store, 'ham.py'): 'spam'}
+    # the package directory is resolved once, not once per file
+    assert realpath.calls == [pretend.call(str(site.join('spam')))]
+
+
+class FakeMetadata:
+    '''Stands in for a distribution's metadata directory.'''
+    def __init__(self, egg_info, **metadata):
+        self.egg_info = egg_info
+        self.metadata = metadata
+
+    def has_metadata(self, name):
+        return name in self.metadata
+
+    def get_metadata_lines(self, name):
+        return iter(self.metadata[name].splitlines())
+
+
+def test_package_info_record():
+    site = os.path.join(os.sep, 'lib', 'site')
+    dist = pkg_resources.DistInfoDistribution(site, project_name='spam',
+        metadata=FakeMetadata(os.path.join(site, 'spam-1.0.dist-info'),
+            RECORD='spam/__init__.py,sha256=abc,123\n'
+                'spam-1.0.dist-info/RECORD,,\n'
+                '../../bin/spam,sha256=def,45\n'))
+    assert common._package_info(dist) == dict(name='spam', location=site,
+        files=sorted([os.path.join('..', '..', 'bin', 'spam'),
+            os.path.join('spam', '__init__.py'),
+            os.path.join('spam-1.0.dist-info', 'RECORD')]))
+
+
+def test_package_info_installed_files():
+    site = os.path.join(os.sep, 'lib', 'site')
+    dist = pkg_resources.Distribution(site, project_name='spam',
+        metadata=FakeMetadata(os.path.join(site, 'spam-1.0.egg-info'),
+            **{'installed-files.txt': '../spam/__init__.py\nPKG-INFO\n'}))
+    assert common._package_info(dist) == dict(name='spam', location=site,
+        files=sorted([os.path.join('spam', '__init__.py'),
+            os.path.join('spam-1.0.egg-info', 'PKG-INFO')]))
+
+
+@pytest.mark.parametrize("distribution", [
+    pkg_resources.DistInfoDistribution, pkg_resources.Distribution])
+def test_package_info_no_files(distribution):
+    site = os.path.join(os.sep, 'lib', 'site')
+    dist = distribution(site, project_name='spam',
+        metadata=FakeMetadata(os.path.join(site, 'spam-1.0.dist-info')))
+    assert common._package_info(dist) == dict(name='spam', location=site)
+
+
+def test_installed_packages_unwritable_cache(monkeypatch, tmpdir):
+    FakeDist = collections.namedtuple('FakeDist', ['project_name'])
+    monkeypatch.setattr(pkg_resources, 'working_set', [FakeDist('spam')])
+    monkeypatch.setattr(common, '_package_info',
+        lambda dist: dict(name=dist.project_name))
+    # (a file where the directory should be)
+    cache_dir = tmpdir.join('cache')
+    cache_dir.write('')
+    common.installed_packages.cache_clear()
+
+    try:
+        assert common.installed_packages(str(cache_dir)) == \
+            (dict(name='spam'),)
+    finally:
+        common.installed_packages.cache_clear()
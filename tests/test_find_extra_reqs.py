@@ -22,6 +22,9 @@ def fake_opts():
             ignore_files = []
             ignore_mods = []
             ignore_reqs = []
+            jobs = 1
+            scan_all_dirs = False
+            cache_dir = None
         options = options()
         args = ['ham.py']
 
@@ -49,10 +52,6 @@ def test_find_extra_reqs(monkeypatch):
     monkeypatch.setattr(common, 'find_imported_modules',
         pretend.call_recorder(lambda a: imported_modules))
 
-    FakeDist = collections.namedtuple('FakeDist', ['project_name'])
-    installed_distributions = map(FakeDist, ['spam', 'pass'])
-    monkeypatch.setattr(find_extra_reqs, 'get_installed_distributions',
-        pretend.call_recorder(lambda: installed_distributions))
     packages_info = [
         dict(name='spam', location='site-spam', files=['spam/__init__.py',
             'spam/shrub.py']),
@@ -60,15 +59,16 @@ def test_find_extra_reqs(monkeypatch):
         dict(name='pass', location='site-spam', files=['pass.py']),
     ]
 
-    monkeypatch.setattr(find_extra_reqs, 'search_packages_info',
-        pretend.call_recorder(lambda x: packages_info))
+    monkeypatch.setattr(common, 'installed_packages',
+        pretend.call_recorder(lambda cache_dir: packages_info))
 
     FakeReq = collections.namedtuple('FakeReq', ['name'])
     requirements = [FakeReq('foobar')]
-    monkeypatch.setattr(common, 'parse_requirements',
-        pretend.call_recorder(lambda a, session=None: requirements))
+    monkeypatch.setattr(common, 'requirements', lambda: iter(requirements))
 
     class options:
+        cache_dir = None
+
         def ignore_reqs(x, y):
             return False
     options = options()
@@ -77,6 +77,38 @@ def test_find_extra_reqs(monkeypatch):
     assert result == ['foobar']
 
 
+def test_find_extra_reqs_package_directory(monkeypatch):
+    imported_modules = dict(
+        spam=common.FoundModule('spam', 'site-spam/spam', [('ham.py', 1)]),
+        shrub=common.FoundModule('shrub', 'site-spam/shrub.py',
+            [('ham.py', 2)]),
+    )
+    monkeypatch.setattr(common, 'find_imported_modules',
+        lambda options: imported_modules)
+
+    def packages_info():
+        yield dict(name='spam', location='site-spam',
+            files=['spam/__init__.py'])
+        yield dict(name='shrub', location='site-spam', files=['shrub.py'])
+        raise AssertionError('kept looking after finding every module')
+    monkeypatch.setattr(common, 'installed_packages',
+        lambda cache_dir: packages_info())
+
+    FakeReq = collections.namedtuple('FakeReq', ['name'])
+    requirements = [FakeReq('spam'), FakeReq('shrub'), FakeReq('pass')]
+    monkeypatch.setattr(common, 'requirements', lambda: iter(requirements))
+
+    class options:
+        cache_dir = None
+
+        def ignore_reqs(x, y):
+            return False
+    options = options()
+
+    result = find_extra_reqs.find_extra_reqs(options)
+    assert result == ['pass']
+
+
 def test_main_failure(monkeypatch, caplog, fake_opts):
     monkeypatch.setattr(optparse, 'OptionParser', fake_opts)
 
@@ -124,6 +156,9 @@ def test_logging_config(monkeypatch, caplog, verbose_cfg, debug_cfg, result):
         ignore_files = []
         ignore_mods = []
         ignore_reqs = []
+        jobs = 1
+        scan_all_dirs = False
+        cache_dir = None
     options = options()
 
     class FakeOptParse:
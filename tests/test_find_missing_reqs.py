@@ -21,6 +21,9 @@ def fake_opts():
             version = False
             ignore_files = []
             ignore_mods = []
+            jobs = 1
+            scan_all_dirs = False
+            cache_dir = None
         options = options()
         args = ['ham.py']
 
@@ -48,10 +51,6 @@ def test_find_missing_reqs(monkeypatch):
     monkeypatch.setattr(common, 'find_imported_modules',
         pretend.call_recorder(lambda a: imported_modules))
 
-    FakeDist = collections.namedtuple('FakeDist', ['project_name'])
-    installed_distributions = map(FakeDist, ['spam', 'pass'])
-    monkeypatch.setattr(find_missing_reqs, 'get_installed_distributions',
-        pretend.call_recorder(lambda: installed_distributions))
     packages_info = [
         dict(name='spam', location='site-spam', files=['spam/__init__.py',
             'spam/shrub.py']),
@@ -59,18 +58,48 @@ def test_find_missing_reqs(monkeypatch):
         dict(name='pass', location='site-spam', files=['pass.py']),
     ]
 
-    monkeypatch.setattr(find_missing_reqs, 'search_packages_info',
-        pretend.call_recorder(lambda x: packages_info))
+    monkeypatch.setattr(common, 'installed_packages',
+        pretend.call_recorder(lambda cache_dir: packages_info))
 
     FakeReq = collections.namedtuple('FakeReq', ['name'])
     requirements = [FakeReq('spam')]
-    monkeypatch.setattr(find_missing_reqs, 'parse_requirements',
-        pretend.call_recorder(lambda a, session=None: requirements))
+    monkeypatch.setattr(common, 'requirements', lambda: iter(requirements))
 
-    result = list(find_missing_reqs.find_missing_reqs(None))
+    class options:
+        cache_dir = None
+
+    result = list(find_missing_reqs.find_missing_reqs(options))
     assert result == [('shrub', [imported_modules['shrub']])]
 
 
+def test_find_missing_reqs_package_directory(monkeypatch):
+    imported_modules = dict(
+        spam=common.FoundModule('spam', 'site-spam/spam', [('ham.py', 1)]),
+        shrub=common.FoundModule('shrub', 'site-spam/shrub.py',
+            [('ham.py', 2)]),
+    )
+    monkeypatch.setattr(common, 'find_imported_modules',
+        lambda options: imported_modules)
+
+    def packages_info():
+        yield dict(name='spam', location='site-spam',
+            files=['spam/__init__.py'])
+        yield dict(name='shrub', location='site-spam', files=['shrub.py'])
+        raise AssertionError('kept looking after finding every module')
+    monkeypatch.setattr(common, 'installed_packages',
+        lambda cache_dir: packages_info())
+
+    FakeReq = collections.namedtuple('FakeReq', ['name'])
+    requirements = [FakeReq('shrub')]
+    monkeypatch.setattr(common, 'requirements', lambda: iter(requirements))
+
+    class options:
+        cache_dir = None
+
+    result = list(find_missing_reqs.find_missing_reqs(options))
+    assert result == [('spam', [imported_modules['spam']])]
+
+
 def test_main_failure(monkeypatch, caplog, fake_opts):
     monkeypatch.setattr(optparse, 'OptionParser', fake_opts)
 
@@ -78,7 +107,7 @@ def test_main_failure(monkeypatch, caplog, fake_opts):
 
     monkeypatch.setattr(find_missing_reqs, 'find_missing_reqs', lambda x: [
         ('missing', [common.FoundModule('missing', 'missing.py',
-            [('location.py', 1)])])
+            [('location.py', 1), ('location.py', 3)])])
     ])
 
     with pytest.raises(SystemExit) as excinfo:
@@ -88,7 +117,8 @@ def test_main_failure(monkeypatch, caplog, fake_opts):
     assert caplog.records[0].message == \
         'Missing requirements:'
     assert caplog.records[1].message == \
-        'location.py:1 dist=missing module=missing'
+        'location.py:1 dist=missing module=missing\n' \
+        'location.py:3 dist=missing module=missing'
 
 
 def test_main_no_spec(monkeypatch, caplog, fake_opts):
@@ -118,6 +148,9 @@ def test_logging_config(monkeypatch, caplog, verbose_cfg, debug_cfg, result):
         version = False
         ignore_files = []
         ignore_mods = []
+        jobs = 1
+        scan_all_dirs = False
+        cache_dir = None
     options = options()
 
     class FakeOptParse: